@@ -1,17 +1,30 @@
-use bytes::Buf;
-use futures::TryStreamExt;
+use bytes::{Buf, Bytes, BytesMut};
+use futures::{Stream, TryStreamExt};
 use rusqlite::{Connection, params};
 use serde::{Deserialize, Serialize};
 use serde_json::json;
-use std::{fs, sync::Arc};
+use std::{
+    fs,
+    sync::{
+        Arc,
+        atomic::{AtomicU64, Ordering},
+    },
+};
+use tokio::io::{AsyncReadExt, AsyncWriteExt};
 use tokio::sync::Mutex;
 use warp::cors;
 use warp::{
     Filter, Rejection, Reply,
     http::StatusCode,
+    http::header::{CONTENT_LENGTH, CONTENT_TYPE, HeaderValue},
+    hyper::Body,
     multipart::{FormData, Part},
 };
 
+const DOWNLOAD_CHUNK_SIZE: usize = 64 * 1024;
+
+static UPLOAD_SEQ: AtomicU64 = AtomicU64::new(0);
+
 #[derive(Serialize, Deserialize, Debug, Clone)]
 struct ModMetadata {
     id: String,
@@ -44,12 +57,9 @@ impl warp::reject::Reject for FileError {}
 #[tokio::main]
 async fn main() {
     let db = Connection::open("mods.db").expect("Failed to open database");
+    setup_db(&db).expect("Failed to setup database");
     let db = Arc::new(Mutex::new(db));
 
-    setup_db(db.clone())
-        .await
-        .expect("Failed to setup database");
-
     fs::create_dir_all("thumbnails").expect("Failed to create thumbnails directory");
     fs::create_dir_all("mods").expect("Failed to create mods directory");
 
@@ -92,8 +102,7 @@ async fn main() {
     warp::serve(routes).run(([0, 0, 0, 0], 8080)).await;
 }
 
-async fn setup_db(db: DbConnection) -> Result<(), rusqlite::Error> {
-    let conn = db.lock().await;
+fn setup_db(conn: &Connection) -> Result<(), rusqlite::Error> {
     conn.execute(
         "CREATE TABLE IF NOT EXISTS mods (
             id TEXT PRIMARY KEY,
@@ -107,41 +116,45 @@ async fn setup_db(db: DbConnection) -> Result<(), rusqlite::Error> {
     Ok(())
 }
 
-async fn handle_get_metadata(db: DbConnection) -> Result<impl Reply, Rejection> {
-    let conn = db.lock().await;
-    let mut stmt = conn
-        .prepare("SELECT id, title, version, thumbnail, file_path FROM mods")
-        .map_err(|e| {
-            warp::reject::custom(DbError {
-                details: e.to_string(),
-            })
-        })?;
-
-    let mods = stmt
-        .query_map([], |row| {
-            Ok(ModMetadata {
-                id: row.get(0)?,
-                title: row.get(1)?,
-                version: row.get(2)?,
-                thumbnail: row.get(3)?,
-                file_path: row.get(4)?,
-            })
-        })
+async fn with_db<T, F>(db: DbConnection, f: F) -> Result<T, Rejection>
+where
+    T: Send + 'static,
+    F: FnOnce(&Connection) -> Result<T, rusqlite::Error> + Send + 'static,
+{
+    let conn = db.lock_owned().await;
+    tokio::task::spawn_blocking(move || f(&conn))
+        .await
         .map_err(|e| {
             warp::reject::custom(DbError {
                 details: e.to_string(),
             })
         })?
-        .collect::<Result<Vec<_>, _>>()
         .map_err(|e| {
             warp::reject::custom(DbError {
                 details: e.to_string(),
             })
-        })?;
+        })
+}
 
+async fn handle_get_metadata(db: DbConnection) -> Result<impl Reply, Rejection> {
+    let mods = with_db(db, load_metadata).await?;
     Ok(warp::reply::json(&mods))
 }
 
+fn load_metadata(conn: &Connection) -> Result<Vec<ModMetadata>, rusqlite::Error> {
+    let mut stmt = conn.prepare("SELECT id, title, version, thumbnail, file_path FROM mods")?;
+    let rows = stmt.query_map([], |row| {
+        Ok(ModMetadata {
+            id: row.get(0)?,
+            title: row.get(1)?,
+            version: row.get(2)?,
+            thumbnail: row.get(3)?,
+            file_path: row.get(4)?,
+        })
+    })?;
+    rows.collect()
+}
+
 async fn handle_upload(db: DbConnection, mut form: FormData) -> Result<impl Reply, Rejection> {
     let mut mod_metadata = ModMetadata {
         id: String::new(),
@@ -188,13 +201,8 @@ async fn handle_upload(db: DbConnection, mut form: FormData) -> Result<impl Repl
                     mod_metadata.thumbnail = base64_thumbnail;
                 }
                 "file" => {
-                    let data = read_part_to_bytes(part).await.map_err(|e| {
-                        warp::reject::custom(UploadError {
-                            details: e.to_string(),
-                        })
-                    })?;
                     let file_path = format!("mods/{}.gz", mod_metadata.id);
-                    fs::write(&file_path, data).map_err(|e| {
+                    write_part_to_file(part, &file_path).await.map_err(|e| {
                         warp::reject::custom(UploadError {
                             details: e.to_string(),
                         })
@@ -206,38 +214,41 @@ async fn handle_upload(db: DbConnection, mut form: FormData) -> Result<impl Repl
         }
     }
 
-    let conn = db.lock().await;
-    let exists: bool = conn
-        .query_row(
-            "SELECT EXISTS(SELECT 1 FROM mods WHERE id = ?1)",
-            params![mod_metadata.id],
-            |row| row.get(0),
-        )
-        .unwrap_or(false);
-
-    if exists {
-        conn.execute(
-            "UPDATE mods SET title = ?1, version = ?2, thumbnail = ?3, file_path = ?4 WHERE id = ?5",
-            params![
-                mod_metadata.title,
-                mod_metadata.version,
-                mod_metadata.thumbnail,
-                mod_metadata.file_path,
-                mod_metadata.id
-            ],
-        ).map_err(|e| warp::reject::custom(DbError{details:e.to_string()}))?;
-    } else {
-        conn.execute(
-            "INSERT INTO mods (id, title, version, thumbnail, file_path) VALUES (?1, ?2, ?3, ?4, ?5)",
-            params![
-                mod_metadata.id,
-                mod_metadata.title,
-                mod_metadata.version,
-                mod_metadata.thumbnail,
-                mod_metadata.file_path
-            ],
-        ).map_err(|e| warp::reject::custom(DbError{details:e.to_string()}))?;
-    }
+    with_db(db, move |conn| {
+        let exists: bool = conn
+            .query_row(
+                "SELECT EXISTS(SELECT 1 FROM mods WHERE id = ?1)",
+                params![mod_metadata.id],
+                |row| row.get(0),
+            )
+            .unwrap_or(false);
+
+        if exists {
+            conn.execute(
+                "UPDATE mods SET title = ?1, version = ?2, thumbnail = ?3, file_path = ?4 WHERE id = ?5",
+                params![
+                    mod_metadata.title,
+                    mod_metadata.version,
+                    mod_metadata.thumbnail,
+                    mod_metadata.file_path,
+                    mod_metadata.id
+                ],
+            )?;
+        } else {
+            conn.execute(
+                "INSERT INTO mods (id, title, version, thumbnail, file_path) VALUES (?1, ?2, ?3, ?4, ?5)",
+                params![
+                    mod_metadata.id,
+                    mod_metadata.title,
+                    mod_metadata.version,
+                    mod_metadata.thumbnail,
+                    mod_metadata.file_path
+                ],
+            )?;
+        }
+        Ok(())
+    })
+    .await?;
 
     Ok(StatusCode::OK)
 }
@@ -256,34 +267,91 @@ async fn read_part_to_bytes(mut part: Part) -> Result<Vec<u8>, warp::Error> {
     Ok(bytes)
 }
 
+struct PartialUpload {
+    path: String,
+    done: bool,
+}
+
+impl Drop for PartialUpload {
+    fn drop(&mut self) {
+        if !self.done {
+            let _ = fs::remove_file(&self.path);
+        }
+    }
+}
+
+async fn write_part_to_file(mut part: Part, path: &str) -> Result<(), std::io::Error> {
+    let seq = UPLOAD_SEQ.fetch_add(1, Ordering::Relaxed);
+    let tmp_path = format!("{}.{}.{}.part", path, std::process::id(), seq);
+    let mut file = tokio::fs::OpenOptions::new()
+        .write(true)
+        .create_new(true)
+        .open(&tmp_path)
+        .await?;
+    let mut tmp = PartialUpload {
+        path: tmp_path,
+        done: false,
+    };
+
+    while let Some(data) = part.data().await {
+        let data = data.map_err(std::io::Error::other)?;
+        file.write_all(data.chunk()).await?;
+    }
+    file.flush().await?;
+    drop(file);
+
+    tokio::fs::rename(&tmp.path, path).await?;
+    tmp.done = true;
+    Ok(())
+}
+
 async fn handle_download(id: String, db: DbConnection) -> Result<impl Reply, Rejection> {
-    let conn = db.lock().await;
-    let file_path: String = conn
-        .query_row(
+    let file_path: String = with_db(db, move |conn| {
+        conn.query_row(
             "SELECT file_path FROM mods WHERE id = ?1",
             params![id],
             |row| row.get(0),
         )
-        .map_err(|e| {
-            warp::reject::custom(DbError {
-                details: e.to_string(),
-            })
-        })?;
+    })
+    .await?;
 
-    let file_data = fs::read(&file_path).map_err(|e| {
+    let file = tokio::fs::File::open(&file_path).await.map_err(|e| {
         warp::reject::custom(FileError {
             details: e.to_string(),
         })
     })?;
-    Ok(file_data)
+    let file_len = file
+        .metadata()
+        .await
+        .map_err(|e| {
+            warp::reject::custom(FileError {
+                details: e.to_string(),
+            })
+        })?
+        .len();
+
+    let mut response = warp::reply::Response::new(Body::wrap_stream(file_stream(file)));
+    let headers = response.headers_mut();
+    headers.insert(
+        CONTENT_TYPE,
+        HeaderValue::from_static("application/octet-stream"),
+    );
+    headers.insert(CONTENT_LENGTH, HeaderValue::from(file_len));
+    Ok(response)
+}
+
+fn file_stream(file: tokio::fs::File) -> impl Stream<Item = Result<Bytes, std::io::Error>> {
+    futures::stream::try_unfold(file, |mut file| async move {
+        let mut buf = BytesMut::with_capacity(DOWNLOAD_CHUNK_SIZE);
+        if file.read_buf(&mut buf).await? == 0 {
+            return Ok(None);
+        }
+        Ok(Some((buf.freeze(), file)))
+    })
 }
 
 async fn handle_setup(db: DbConnection) -> Result<impl Reply, Rejection> {
-    setup_db(db).await.map_err(|e| {
-        warp::reject::custom(DbError {
-            details: e.to_string(),
-        })
-    })?;
+    with_db(db, setup_db).await?;
     Ok(StatusCode::OK)
 }
 